@@ -2,10 +2,18 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import torch.optim as optim
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel as DDP
+from torch.utils.data.distributed import DistributedSampler
+from torch.cuda.amp import autocast, GradScaler
+from torch.ao.quantization import quantize_dynamic, get_default_qconfig_mapping
+from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
 import torchvision.datasets as datasets
 import torchvision.transforms as transforms
 import numpy as np
 
+import os
+import copy
 import datetime
 import argparse
 import matplotlib.pyplot as plt
@@ -41,36 +49,43 @@ def train(args,
           model, 
           device, 
           train_loader, 
-          test_loader, 
           optimizer, 
+          scaler,
           epoch):
 
     model.train()
     lr = optimizer.param_groups[0]['lr']
-    correct = 0
+    # accumulate on the device, .item() forces a sync so only log periodically
+    loss_sum = torch.zeros((), device=device)
+    acc_sum = torch.zeros((), device=device)
     total = 0
-    losses = AverageMeter()
     
     for i, data in enumerate(train_loader):
-        inputs, labels = data[0].to(device), data[1].to(device)
-        optimizer.zero_grad()
-        outputs = model(inputs)
-        loss = nn.CrossEntropyLoss()(outputs, labels)
-        loss.backward()
-        optimizer.step()
-        losses.update(loss.float().mean().item())
-
-        _, predicted = outputs.max(1)
+        inputs = data[0].to(device, non_blocking=True, memory_format=args.memory_format)
+        labels = data[1].to(device, non_blocking=True)
+        if args.normalize:
+            inputs = inputs.sub_(0.1307).div_(0.3081)
+        optimizer.zero_grad(set_to_none=True)
+        with autocast(enabled=args.amp, dtype=args.amp_dtype):
+            outputs = model(inputs)
+            loss = F.cross_entropy(outputs, labels)
+        scaler.scale(loss).backward()
+        scaler.step(optimizer)
+        scaler.update()
+        loss_sum += loss.detach().float()
+
+        acc1, = accuracy(outputs, labels, (1,))
+        acc_sum += acc1[0] * labels.size(0)
         total += labels.size(0)
-        correct += predicted.eq(labels).sum().item()
-        acc = correct * 100. / total
-
-        progress_bar(i,
-                    len(train_loader),
-                    '[Epoch %d] CE: %.4f | Top 1 Acc: %0.2f%% | LR: %.2e'
-                    % (epoch, losses.avg, acc, lr))
 
-    return test(args, model, device, test_loader)
+        if not args.main_process:
+            continue
+        if i % args.log_interval == 0 or i == len(train_loader) - 1:
+            acc = acc_sum.item() / total
+            progress_bar(i,
+                        len(train_loader),
+                        '[Epoch %d] CE: %.4f | Top 1 Acc: %0.2f%% | LR: %.2e'
+                        % (epoch, loss_sum.item() / (i + 1), acc, lr))
 
 
 def test(args, model, device, test_loader):
@@ -79,13 +94,21 @@ def test(args, model, device, test_loader):
     top5 = AverageMeter()
     with torch.no_grad():
         for i, data in enumerate(test_loader):
-            inputs, labels = data[0].to(device), data[1].to(device)
-            outputs = model(inputs)
+            # a non_blocking copy back to the cpu is not waited for before use
+            non_blocking = device.type == 'cuda'
+            inputs = data[0].to(device, non_blocking=non_blocking, memory_format=args.memory_format)
+            labels = data[1].to(device, non_blocking=non_blocking)
+            if args.normalize:
+                inputs = inputs.sub_(0.1307).div_(0.3081)
+            with autocast(enabled=args.amp, dtype=args.amp_dtype):
+                outputs = model(inputs)
 
             acc1, acc5 = accuracy(outputs, labels, (1, 5))
             top1.update(acc1[0], inputs.size(0))
             top5.update(acc5[0], inputs.size(0))
 
+            if not args.main_process:
+                continue
             progress_bar(i,
                          len(test_loader),
                          'Test accuracy Top 1: %0.2f%%, Top 5: %0.2f%%'
@@ -93,6 +116,100 @@ def test(args, model, device, test_loader):
     return top1.avg, top5.avg
 
 
+def script_model(args, model, device):
+    """Freezes an eval-only TorchScript copy of the model for inference"""
+    model.eval()
+    inputs = torch.zeros(args.batch_size, 1, 28, 28, device=device)
+    inputs = inputs.to(memory_format=args.memory_format)
+    # trace rather than script, einops.rearrange in ViT is not scriptable
+    with torch.no_grad():
+        scripted = torch.jit.trace(model, inputs)
+        scripted = torch.jit.optimize_for_inference(scripted)
+        # the profiling executor fuses kernels after a few runs
+        with torch.jit.optimized_execution(True):
+            for _ in range(3):
+                scripted(inputs)
+    return scripted
+
+
+def quantize_model(args, model, calib_loader, calib_batches=10):
+    """Post-training int8 quantization, the quantized kernels run on cpu"""
+    model = copy.deepcopy(model).cpu().eval()
+    if not args.cnn:
+        # vit is dominated by linear layers, dynamic quantization needs no calibration
+        return quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+
+    # static quantization of the cnn, calibrate activation ranges on training batches
+    inputs = torch.zeros(1, 1, 28, 28).to(memory_format=args.memory_format)
+    model = prepare_fx(model, get_default_qconfig_mapping(), (inputs,))
+    with torch.no_grad():
+        for i, data in enumerate(calib_loader):
+            if i == calib_batches:
+                break
+            inputs = data[0]
+            if args.normalize:
+                inputs = inputs.sub(0.1307).div(0.3081)
+            model(inputs)
+    return convert_fx(model)
+
+
+class TensorLoader:
+    """Iterates over a dataset that is held entirely in device memory"""
+    def __init__(self, dataset, device, batch_size, shuffle=False):
+        self.images = torch.stack([dataset[i][0] for i in range(len(dataset))]).to(device)
+        self.labels = torch.as_tensor(dataset.targets).to(device)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+
+    def __len__(self):
+        return (len(self.labels) + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        n = len(self.labels)
+        if self.shuffle:
+            index = torch.randperm(n, device=self.labels.device)
+        else:
+            index = torch.arange(n, device=self.labels.device)
+        for i in range(0, n, self.batch_size):
+            batch = index[i:i + self.batch_size]
+            yield self.images[batch], self.labels[batch]
+
+
+class CudaPrefetcher:
+    """Copies the next batch to the gpu on a side stream while the current one is used"""
+    def __init__(self, loader, device, memory_format=torch.contiguous_format):
+        self.loader = loader
+        self.device = device
+        self.memory_format = memory_format
+        self.stream = torch.cuda.Stream(device)
+
+    def __len__(self):
+        return len(self.loader)
+
+    def preload(self, it):
+        try:
+            inputs, labels = next(it)
+        except StopIteration:
+            return None
+        with torch.cuda.stream(self.stream):
+            inputs = inputs.to(self.device, non_blocking=True, memory_format=self.memory_format)
+            labels = labels.to(self.device, non_blocking=True)
+        return inputs, labels
+
+    def __iter__(self):
+        it = iter(self.loader)
+        batch = self.preload(it)
+        while batch is not None:
+            current_stream = torch.cuda.current_stream(self.device)
+            current_stream.wait_stream(self.stream)
+            inputs, labels = batch
+            # the copies were allocated on the side stream
+            inputs.record_stream(current_stream)
+            labels.record_stream(current_stream)
+            batch = self.preload(it)
+            yield inputs, labels
+
+
 class SaveOutput:
     def __init__(self):
         self.outputs = []
@@ -148,14 +265,14 @@ def plot_data(args, maps, dim, title=""):
     maps = maps - np.amin(maps)
     maps = maps / np.amax(maps)
 
-    axes = []
-    for i, m in enumerate(maps):
-        ax = plt.subplot(dim, dim, i+1)
-        axes.append(ax)
-        im = plt.imshow(m, cmap="gray")
-        plt.axis('off')
-    
-    fig.colorbar(im, ax=axes)
+    # tile the maps into one (dim*h, dim*w) image instead of dim*dim subplots
+    _, h, w = maps.shape
+    grid = maps[:dim * dim].reshape(dim, dim, h, w)
+    grid = grid.transpose(0, 2, 1, 3).reshape(dim * h, dim * w)
+    im = plt.imshow(grid, cmap="gray")
+    plt.axis('off')
+
+    fig.colorbar(im)
     plt.suptitle(title, fontsize=14)
     plt.show()
 
@@ -180,6 +297,16 @@ def main():
                         default=10,
                         metavar='N',
                         help='number of epochs to train (default: 10)')
+    parser.add_argument('--eval-every',
+                        type=int,
+                        default=1,
+                        metavar='N',
+                        help='epochs between test set evaluations (default: 1)')
+    parser.add_argument('--log-interval',
+                        type=int,
+                        default=10,
+                        metavar='N',
+                        help='batches between training progress updates (default: 10)')
     parser.add_argument('--layer-num',
                         type=int,
                         default=0,
@@ -209,22 +336,76 @@ def main():
                         action='store_true',
                         default=False,
                         help='use cnn model instead of transformer (default: False)')
+    parser.add_argument('--compile',
+                        action='store_true',
+                        default=False,
+                        help='fuse the model kernels with torch.compile (default: False)')
+    parser.add_argument('--jit-eval',
+                        action='store_true',
+                        default=False,
+                        help='evaluate a frozen TorchScript copy of the final model (default: False)')
+    parser.add_argument('--int8-eval',
+                        action='store_true',
+                        default=False,
+                        help='evaluate an int8 quantized copy of the final model on cpu (default: False)')
+    parser.add_argument('--num-workers',
+                        type=int,
+                        default=min(8, os.cpu_count() or 1),
+                        metavar='N',
+                        help='dataloader worker processes (default: min(8, cpu count))')
+    parser.add_argument('--pin-memory',
+                        action=argparse.BooleanOptionalAction,
+                        default=True,
+                        help='use pinned host memory when there are workers')
+    parser.add_argument('--gpu-data',
+                        action='store_true',
+                        default=False,
+                        help='preload the whole dataset in gpu memory (default: False)')
     parser.add_argument('--visualize',
                         action='store_true',
                         default=False,
                         help='plot kernel and feature maps (default: False)')
     
     args = parser.parse_args()
+    if args.log_interval < 1:
+        parser.error("--log-interval must be at least 1")
+    if args.eval_every < 1:
+        parser.error("--eval-every must be at least 1")
     use_cuda = torch.cuda.is_available()
-
-    kwargs = {'num_workers': 4, 'pin_memory': True} if use_cuda else {}
-
-    if args.normalize:
-        transform = transforms.Compose([transforms.ToTensor(),
-                                       transforms.Normalize((0.1307,), (0.3081,))])
+    if args.gpu_data and not use_cuda:
+        parser.error("--gpu-data needs a cuda device")
+    if args.gpu_data and 'LOCAL_RANK' in os.environ:
+        parser.error("--gpu-data is not sharded, it cannot be used with torchrun")
+    # input shapes are fixed, let cudnn pick the fastest conv algorithm
+    torch.backends.cudnn.benchmark = True
+    # tf32 matmul/conv on ampere+ for whatever autocast leaves in fp32
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
+
+    # pinned host memory only pays off when workers feed async h2d copies
+    kwargs = {'num_workers': args.num_workers,
+              'pin_memory': use_cuda and args.pin_memory and args.num_workers > 0}
+    if args.num_workers > 0:
+        kwargs.update({'persistent_workers': True, 'prefetch_factor': 4})
+
+    # one process per gpu when launched with torchrun
+    distributed = use_cuda and 'LOCAL_RANK' in os.environ
+    if distributed:
+        dist.init_process_group('nccl')
+        local_rank = int(os.environ['LOCAL_RANK'])
+        torch.cuda.set_device(local_rank)
+        device = torch.device("cuda", local_rank)
     else:
-        transform = transforms.Compose([transforms.ToTensor()])
+        device = torch.device("cuda" if use_cuda else "cpu")
+    # only rank 0 prints progress and results
+    args.main_process = not distributed or dist.get_rank() == 0
 
+    # --normalize is applied on the device in train() and test()
+    transform = transforms.Compose([transforms.ToTensor()])
+
+    # rank 0 downloads the dataset while the other ranks wait for it
+    if distributed and not args.main_process:
+        dist.barrier()
     x_train = datasets.MNIST(root='./data',
                              train=True,
                              download=True,
@@ -234,23 +415,44 @@ def main():
                             train=False,
                             download=True,
                             transform=transform)
+    if distributed and args.main_process:
+        dist.barrier()
+
+    # cudnn prefers nhwc for tensor core convolutions
+    args.memory_format = torch.channels_last if args.cnn else torch.contiguous_format
+
+    train_sampler = None
+    if args.gpu_data:
+        # mnist fits in gpu memory, so skip the worker/collate/h2d pipeline
+        train_loader = TensorLoader(x_train,
+                                    device,
+                                    shuffle=True,
+                                    batch_size=args.batch_size)
+
+        test_loader = TensorLoader(x_test,
+                                   device,
+                                   shuffle=False,
+                                   batch_size=args.batch_size)
+    else:
+        DataLoader = torch.utils.data.DataLoader
+        if distributed:
+            train_sampler = DistributedSampler(x_train, shuffle=True)
+        train_loader = DataLoader(x_train,
+                                  shuffle=train_sampler is None,
+                                  sampler=train_sampler,
+                                  batch_size=args.batch_size,
+                                  **kwargs)
+        if use_cuda:
+            # overlap the h2d copy of the next batch with compute
+            train_loader = CudaPrefetcher(train_loader, device, args.memory_format)
+
+        test_loader = DataLoader(x_test,
+                                 shuffle=False,
+                                 batch_size=args.batch_size,
+                                 **kwargs)
 
-    DataLoader = torch.utils.data.DataLoader
-    train_loader = DataLoader(x_train,
-                              shuffle=True,
-                              batch_size=args.batch_size,
-                              **kwargs)
-
-    test_loader = DataLoader(x_test,
-                             shuffle=False,
-                             batch_size=args.batch_size,
-                             **kwargs)
-
-
-    use_cuda = torch.cuda.is_available()
-    device = torch.device("cuda" if use_cuda else "cpu")
     if args.cnn:
-        model = CNNModel().to(device)
+        model = CNNModel().to(device, memory_format=args.memory_format)
     else:
         model = ViT(image_size=28,
                     patch_size=14,
@@ -262,40 +464,95 @@ def main():
                     channels=1,
                     ).to(device)
 
-    if torch.cuda.device_count() > 1:
+    if distributed:
+        print("Process %d of %d on GPU %d" % (dist.get_rank(), dist.get_world_size(), local_rank))
+        model = DDP(model, device_ids=[local_rank])
+    elif torch.cuda.device_count() > 1:
         print("Available GPUs:", torch.cuda.device_count())
-        model = nn.DataParallel(model)
-    print("Model:", model)
-    print("Device:", device)
-    optimizer = optim.Adam(model.parameters())
-    
+        print("Using a single GPU, launch with torchrun to train on all of them")
+    if args.main_process:
+        print("Model:", model)
+        print("Device:", device)
+    # single fused kernel over all parameters on cuda, batched foreach ops on cpu
+    if use_cuda:
+        optimizer = optim.Adam(model.parameters(), lr=args.lr, fused=True)
+    else:
+        optimizer = optim.Adam(model.parameters(), lr=args.lr, foreach=True)
+    # mixed precision on cuda, plain fp32 on cpu
+    # bf16 has the fp32 exponent range so loss scaling is only needed for fp16
+    use_bf16 = use_cuda and torch.cuda.get_device_capability(device)[0] >= 8
+    args.amp = use_cuda
+    args.amp_dtype = torch.bfloat16 if use_bf16 else torch.float16
+    scaler = GradScaler(enabled=use_cuda and not use_bf16)
+
+    # the compiled/ddp modules share their parameters with the eager one,
+    # checkpoints and visualization hooks go through the unwrapped eager one
+    eager_model = model.module if distributed else model
+    if args.compile:
+        # cuda graphs (reduce-overhead) are single-gpu only, ddp keeps the default mode
+        mode = 'default' if distributed else 'reduce-overhead'
+        model = torch.compile(model, mode=mode, fullgraph=False)
+        # warm up so the one-time compile is not counted as training time
+        with autocast(enabled=args.amp, dtype=args.amp_dtype):
+            inputs = torch.zeros(args.batch_size, 1, 28, 28, device=device)
+            model(inputs.to(memory_format=args.memory_format))
+
     start_time = datetime.datetime.now()
     best_top1 = 0
     best_top5 = 0
     if args.restore_model is not None:
-        model.load_state_dict(torch.load(args.restore_model)) 
+        eager_model.load_state_dict(torch.load(args.restore_model, map_location=device))
         best_top1, best_top5 = test(args, model, device, test_loader)
-        print("Best Top 1: %0.2f%%, Top 5: %0.2f%%" % (best_top1, best_top5))
+        if args.main_process:
+            print("Best Top 1: %0.2f%%, Top 5: %0.2f%%" % (best_top1, best_top5))
 
     if args.train:
         for epoch in range(1, args.epochs + 1):
-            top1, top5 = train(args, model, device, train_loader, test_loader, optimizer, epoch)
+            if train_sampler is not None:
+                train_sampler.set_epoch(epoch)
+            train(args, model, device, train_loader, optimizer, scaler, epoch)
+            # early epochs are noisy, always evaluate the last one
+            if epoch % args.eval_every != 0 and epoch != args.epochs:
+                continue
+            top1, top5 = test(args, model, device, test_loader)
             if top1 > best_top1:
-                print("New best Top 1: %0.2f%%, Top 5: %0.2f%%" % (top1, top5))
+                if args.main_process:
+                    print("New best Top 1: %0.2f%%, Top 5: %0.2f%%" % (top1, top5))
                 best_top1 = top1
                 best_top5 = top5
-                if args.save_model:
+                if args.save_model and args.main_process:
                     filename = "cnn-mnist.pth" if args.cnn else "transformer-mnist.pth"
-                    torch.save(model.state_dict(), filename)
+                    torch.save(eager_model.state_dict(), filename)
                     print("Saving best model on file: ", filename)
 
-        print("Best Top 1: %0.2f%%, Top 5: %0.2f%% in %d epochs" % (best_top1, best_top5, args.epochs))
+        if args.main_process:
+            print("Best Top 1: %0.2f%%, Top 5: %0.2f%% in %d epochs" % (best_top1, best_top5, args.epochs))
 
     elapsed_time = datetime.datetime.now() - start_time
-    print("Elapsed time (train): %s" % elapsed_time)
-
-    if args.visualize:
-        viz_features(args, model)
+    if args.main_process:
+        print("Elapsed time (train): %s" % elapsed_time)
+
+    # eval-only copies and plots are built once, on rank 0
+    if args.jit_eval and args.main_process:
+        scripted = script_model(args, eager_model, device)
+        with torch.jit.optimized_execution(True):
+            top1, top5 = test(args, scripted, device, test_loader)
+        print("TorchScript Top 1: %0.2f%%, Top 5: %0.2f%%" % (top1, top5))
+
+    if args.int8_eval and args.main_process:
+        # calibrate from the host dataset, independent of the cuda loading path
+        calib_loader = torch.utils.data.DataLoader(x_train,
+                                                   shuffle=True,
+                                                   batch_size=args.batch_size)
+        quantized = quantize_model(args, eager_model, calib_loader)
+        top1, top5 = test(args, quantized, torch.device("cpu"), test_loader)
+        print("Int8 Top 1: %0.2f%%, Top 5: %0.2f%%" % (top1, top5))
+
+    if args.visualize and args.main_process:
+        viz_features(args, eager_model)
+
+    if distributed:
+        dist.destroy_process_group()
 
 
 if __name__ == '__main__':